@@ -1,22 +1,36 @@
 import os
-import json
+import hmac
+import hashlib
+import logging
+import ipaddress
+import re
+import asyncio
 import string
-import random
+import time
+import secrets
 from datetime import datetime, timedelta, timezone
 from typing import Optional
-from urllib.parse import parse_qs
-import xml.etree.ElementTree as ET
 
-from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
+try:
+    import fcntl
+except ImportError:  # Windows (desenvolvimento local): sem trava entre workers
+    fcntl = None
+
+from fastapi import BackgroundTasks, FastAPI, Request
+from fastapi.responses import JSONResponse, ORJSONResponse, Response
 from pydantic import BaseModel
+from cachetools import TTLCache
 
+from google.api_core.exceptions import AlreadyExists
 from google.cloud import firestore
-from google.oauth2 import service_account
+from google.cloud.firestore import FieldFilter
 from dotenv import load_dotenv
-import smtplib
+import aiosmtplib
+import orjson
+from email.header import Header
 from email.mime.text import MIMEText
-import requests
+import httpx
+from lxml import etree
 
 # --------------------------------------------------------------------
 # CARREGAR VARIÁVEIS DO .env
@@ -24,52 +38,95 @@ import requests
 
 load_dotenv()  # carrega MEUDANFE_API_KEY, SMTP_*, LICENCE_DAYS etc.
 
+# Nível de log configurável (DEBUG mostra headers, corpo e XML do PagBank).
+# Vale só para este módulo: as bibliotecas ficam em WARNING (o httpx, em
+# INFO, logaria a URL do PagBank com o token na query string).
+logging.basicConfig(
+    level=logging.WARNING,
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+)
+log = logging.getLogger(__name__)
+log.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+
 # --------------------------------------------------------------------
-# CONFIGURAÇÕES FIRESTORE (LOCAL + KOYEB)
+# LOG DE ACESSO DO UVICORN SEM SEGREDOS
 # --------------------------------------------------------------------
 
-# 1) Para Koyeb: JSON inteiro do service account em variável de ambiente
-SERVICE_ACCOUNT_JSON = os.getenv("GOOGLE_SERVICE_ACCOUNT_JSON")
+# O uvicorn.access grava o caminho com a query string: sem este filtro, o
+# ?secret= do webhook do PagBank (ver PAGBANK_WEBHOOK_SECRET) e o código da
+# licença em GET /licencas/{codigo} (que funciona como senha) sairiam em
+# texto puro
+_SEGREDO_URL_RE = re.compile(r"(secret=)[^&\s]+|(/licencas/)(?!validar\b)[^/?\s]+")
+
+
+def _ocultar_segredo(m: re.Match) -> str:
+    return (m.group(1) or m.group(2)) + "***"
+
+
+class OcultarSegredoAccessLog(logging.Filter):
+    """Troca ?secret= e o código da licença por *** no uvicorn.access."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if isinstance(record.args, tuple):
+            record.args = tuple(
+                _SEGREDO_URL_RE.sub(_ocultar_segredo, arg)
+                if isinstance(arg, str)
+                else arg
+                for arg in record.args
+            )
+        return True
+
+
+# O uvicorn configura o logging antes de importar o app, então o filtro
+# adicionado aqui não é sobrescrito
+logging.getLogger("uvicorn.access").addFilter(OcultarSegredoAccessLog())
+
+# --------------------------------------------------------------------
+# CONFIGURAÇÕES FIRESTORE (LOCAL + KOYEB)
+# --------------------------------------------------------------------
 
-# 2) Para uso local: caminho do arquivo JSON
+# Todas as formas de login usam as credenciais padrão do Google (ADC), que
+# leem o arquivo apontado por GOOGLE_APPLICATION_CREDENTIALS.
+#
+# 1) Koyeb/container: o prep.py grava o JSON de GOOGLE_SERVICE_ACCOUNT_JSON
+#    em disco e define GOOGLE_APPLICATION_CREDENTIALS antes de subir o uvicorn
+#
+# 2) Uso local: caminho do arquivo JSON
 SERVICE_ACCOUNT_FILE = os.getenv(
     "GOOGLE_APPLICATION_CREDENTIALS_JSON", "service-account.json"
 )
 
-# 3) Flag pra decidir se usa arquivo JSON em vez de credencial padrão
-#    No Koyeb: USE_SERVICE_ACCOUNT_FILE=false
-#    Local:    USE_SERVICE_ACCOUNT_FILE=true (e service-account.json no projeto)
+# 3) Flag pra decidir se usa o arquivo local quando
+#    GOOGLE_APPLICATION_CREDENTIALS não estiver definida
+#    Local: USE_SERVICE_ACCOUNT_FILE=true (e service-account.json no projeto)
 USE_SERVICE_ACCOUNT_FILE = (
     os.getenv("USE_SERVICE_ACCOUNT_FILE", "true").lower() == "true"
 )
 
+if USE_SERVICE_ACCOUNT_FILE and os.path.exists(SERVICE_ACCOUNT_FILE):
+    os.environ.setdefault("GOOGLE_APPLICATION_CREDENTIALS", SERVICE_ACCOUNT_FILE)
+
+# O JSON da conta de serviço só é aproveitado pelo prep.py: subindo o uvicorn
+# direto (ex.: comando sobrescrito no Koyeb) o Firestore fica sem credenciais
+if os.getenv("GOOGLE_SERVICE_ACCOUNT_JSON") and not os.getenv(
+    "GOOGLE_APPLICATION_CREDENTIALS"
+):
+    log.warning(
+        "GOOGLE_SERVICE_ACCOUNT_JSON definida mas GOOGLE_APPLICATION_CREDENTIALS "
+        "não: suba o app pelo prep.py (python prep.py main:app ...) para que o "
+        "JSON seja gravado em disco e usado pelo Firestore"
+    )
+
 db = None
 try:
-    if SERVICE_ACCOUNT_JSON:
-        # Modo Koyeb: JSON inteiro em variável de ambiente
-        print(
-            "Usando credenciais do JSON da variável de ambiente GOOGLE_SERVICE_ACCOUNT_JSON"
-        )
-        info = json.loads(SERVICE_ACCOUNT_JSON)
-        credentials = service_account.Credentials.from_service_account_info(info)
-        project_id = info.get("project_id")
-        db = firestore.Client(credentials=credentials, project=project_id)
-        print(f"Firestore conectado ao projeto (JSON env): {project_id}")
-    elif USE_SERVICE_ACCOUNT_FILE:
-        # Modo desenvolvimento local (usa service-account.json)
-        print(f"Tentando carregar credenciais do arquivo: {SERVICE_ACCOUNT_FILE}")
-        credentials = service_account.Credentials.from_service_account_file(
-            SERVICE_ACCOUNT_FILE
-        )
-        db = firestore.Client(credentials=credentials, project=credentials.project_id)
-        print(f"Firestore conectado ao projeto (arquivo): {credentials.project_id}")
-    else:
-        # Modo “ADC” (não deve ser usado no Koyeb, mais pra Cloud Run)
-        print("Tentando usar credenciais padrão do Google (ADC)")
-        db = firestore.Client()
-        print("Firestore conectado usando ADC")
+    log.info(
+        "Usando credenciais padrão do Google (ADC): %s",
+        os.getenv("GOOGLE_APPLICATION_CREDENTIALS", "ambiente"),
+    )
+    db = firestore.AsyncClient()
+    log.info("Firestore conectado ao projeto: %s", db.project)
 except Exception as e:
-    print("ERRO ao criar cliente Firestore:", e)
+    log.error("ERRO ao criar cliente Firestore: %s", e)
     db = None
 
 # --------------------------------------------------------------------
@@ -90,11 +147,79 @@ SMTP_USER = os.getenv("SMTP_USER")
 SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
 FROM_EMAIL = os.getenv("FROM_EMAIL", SMTP_USER or "")
 
+# Pool de conexões SMTP: quantas conexões autenticadas ficam abertas (por
+# worker) e quantas mensagens cada uma envia antes de ser reciclada. O envio
+# em lote usa uma conexão por vez; a segunda atende o envio avulso quando a
+# fila enche. SMTP_TIMEOUT limita conexão e comandos (o padrão do aiosmtplib
+# é 60 s, o que travaria a subida do worker com o servidor fora do ar).
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", "2"))
+SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", "10"))
+SMTP_MAX_MENSAGENS_POR_CONEXAO = int(os.getenv("SMTP_MAX_MENSAGENS_POR_CONEXAO", "100"))
+
 # Quantidade de dias de validade de cada licença
 DEFAULT_LICENCE_DAYS = int(os.getenv("LICENCE_DAYS", "30"))
 
 # Nome da coleção no Firestore (a que você já está usando)
 LICENCES_COLLECTION = "sticky-notes"
+LICENCES_COL = db.collection(LICENCES_COLLECTION) if db is not None else None
+
+# Transações do PagBank que já geraram licença (evita licença duplicada em
+# reenvios do webhook). Os documentos são apagados pela política de TTL do
+# Firestore no campo "apagar_em" (ver firestore.indexes.json).
+# O prazo precisa sobrar bem além da última notificação "paga" possível: o
+# status 4 (Disponível) chega quando a liberação termina (~30 dias depois do
+# 3 em planos de 30 dias) e disputas (5) podem voltar a 3/4 ainda mais tarde.
+# Com 30 dias o marcador sumia justo quando o 4 chegava (o TTL apaga em até
+# ~24 h após apagar_em) e a mesma compra gerava uma segunda licença.
+PAGBANK_SEEN_COLLECTION = "pagbank_seen"
+PAGBANK_SEEN_COL = db.collection(PAGBANK_SEEN_COLLECTION) if db is not None else None
+PAGBANK_SEEN_TTL_DAYS = int(os.getenv("PAGBANK_SEEN_TTL_DAYS", "180"))
+
+# Limite de operações por commit de WriteBatch no Firestore
+FIRESTORE_BATCH_LIMIT = 500
+
+# Quantas gravações de licença podem estar em andamento ao mesmo tempo
+_EMISSAO_SEMAPHORE = asyncio.Semaphore(40)
+
+# Quantas vezes tentamos um código novo se o gerado já existir
+EMISSAO_TENTATIVAS = 5
+
+# De quantos em quantos minutos as licenças vencidas são marcadas como
+# "expirado" no Firestore (consulta usa o índice composto status+expira_em,
+# definido em firestore.indexes.json)
+EXPIRY_SWEEP_MINUTES = int(os.getenv("EXPIRY_SWEEP_MINUTES", "15"))
+
+# A varredura roda em um só worker por container: quem pega a trava do
+# arquivo abaixo varre, os demais só tentam pegá-la de novo a cada ciclo
+# (assumem se o dono morrer). Com várias instâncias, deixe
+# EXPIRY_SWEEP_ENABLED=true em apenas uma (ou use um agendador externo).
+EXPIRY_SWEEP_ENABLED = os.getenv("EXPIRY_SWEEP_ENABLED", "true").lower() == "true"
+EXPIRY_SWEEP_LOCK_FILE = os.getenv(
+    "EXPIRY_SWEEP_LOCK_FILE", "/tmp/monetizado-varredura.lock"
+)
+
+# Cache em memória das licenças consultadas (evita um read no Firestore a
+# cada validação da extensão). Cada worker tem o seu próprio cache.
+# Entradas com mais de LIC_CACHE_STALE_AFTER segundos ainda são servidas,
+# mas disparam uma releitura em segundo plano (stale-while-revalidate);
+# depois de LIC_CACHE_TTL segundos a entrada some e a leitura volta a ser
+# feita na hora.
+LIC_CACHE_STALE_AFTER = int(os.getenv("LIC_CACHE_STALE_AFTER", "30"))
+LIC_CACHE_TTL = int(os.getenv("LIC_CACHE_TTL", "300"))
+LIC_CACHE_MAXSIZE = int(os.getenv("LIC_CACHE_MAXSIZE", "10000"))
+_LIC_CACHE: TTLCache = TTLCache(  # codigo -> (lido_em, dados)
+    maxsize=LIC_CACHE_MAXSIZE, ttl=LIC_CACHE_TTL
+)
+_LIC_REVALIDANDO: dict[str, asyncio.Task] = {}
+
+# Por quantos segundos a extensão pode reaproveitar uma resposta de
+# GET /licencas/{codigo} sem consultar o backend (Cache-Control: max-age)
+VALIDACAO_MAX_AGE = int(os.getenv("VALIDACAO_MAX_AGE", "60"))
+
+# Formato aceito para códigos de licença: blocos alfanuméricos separados por
+# hífen (cobre os códigos gerados, antigos e novos, e os cadastrados à mão,
+# como "TESTE-1234"). Qualquer outra coisa nem chega a consultar o Firestore.
+_LIC_RE = re.compile(r"[A-Z0-9]{1,16}(?:-[A-Z0-9]{1,16}){1,3}")
 
 # Dados da API clássica de notificação PagBank / PagSeguro
 PAGBANK_EMAIL = os.getenv("PAGBANK_EMAIL")
@@ -105,13 +230,48 @@ PAGBANK_NOTIFICATION_BASE_URL = os.getenv(
     "https://ws.pagseguro.uol.com.br/v3/transactions/notifications",
 )
 
+# Filtros baratos de origem do webhook, aplicados antes de qualquer chamada
+# ao PagBank/Firestore (a notificação clássica do PagBank não é assinada):
+# - PAGBANK_WEBHOOK_SECRET: segredo incluído na URL de notificação cadastrada
+#   no PagBank (.../pagbank/webhook?secret=...). O valor é mascarado no log
+#   de acesso do uvicorn (ver OcultarSegredoAccessLog), mas proxies e o log
+#   de requisições da plataforma (ex.: Cloud Run) ainda gravam a URL completa:
+#   restrinja quem lê esses logs ou troque o segredo se vazar.
+# - PAGBANK_ALLOWED_NETWORKS: redes de origem aceitas, separadas por vírgula
+#   (ex.: "203.0.113.0/24,2001:db8::/32"). Atrás de proxy, o uvicorn precisa
+#   de --forwarded-allow-ips para enxergar o IP real do PagBank.
+# Vazio desativa o respectivo filtro.
+PAGBANK_WEBHOOK_SECRET = os.getenv("PAGBANK_WEBHOOK_SECRET", "")
+PAGBANK_ALLOWED_NETWORKS = [
+    ipaddress.ip_network(rede.strip(), strict=False)
+    for rede in os.getenv("PAGBANK_ALLOWED_NETWORKS", "").split(",")
+    if rede.strip()
+]
+
+# Cliente HTTP compartilhado: mantém conexões keep-alive com o PagBank,
+# evitando um handshake TLS novo a cada webhook
+HTTP = httpx.AsyncClient(
+    timeout=15,
+    follow_redirects=True,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+)
+
 if not PAGBANK_EMAIL or not PAGBANK_TOKEN:
-    print(
+    log.warning(
         "ATENÇÃO: PAGBANK_EMAIL ou PAGBANK_TOKEN não configurados. "
         "Webhook não conseguirá consultar a notificação no PagBank."
     )
 
-app = FastAPI(title="Backend de Licenças da Extensão NF")
+app = FastAPI(
+    title="Backend de Licenças da Extensão NF",
+    default_response_class=ORJSONResponse,
+)
+
+
+@app.on_event("shutdown")
+async def fechar_cliente_http():
+    await HTTP.aclose()
+
 
 # --------------------------------------------------------------------
 # MODELOS P/ REQUISIÇÕES E RESPOSTAS
@@ -122,11 +282,19 @@ class LicencaValidarRequest(BaseModel):
     licenca: str  # exemplo: "TESTE-1234" (sem @#)
 
 
-class LicencaValidarResponse(BaseModel):
-    ok: bool
-    motivo: Optional[str] = None
-    expira_em: Optional[str] = None  # ISO 8601
-    api_key_meudanfe: Optional[str] = None
+def resposta_validacao(
+    ok: bool,
+    motivo: Optional[str] = None,
+    expira_em: Optional[str] = None,  # ISO 8601
+) -> dict:
+    # Resposta de /licencas/validar como dict simples (serializado direto
+    # pelo orjson, sem passar por um modelo Pydantic a cada requisição)
+    return {
+        "ok": ok,
+        "motivo": motivo,
+        "expira_em": expira_em,
+        "api_key_meudanfe": None,
+    }
 
 
 # --------------------------------------------------------------------
@@ -134,53 +302,258 @@ class LicencaValidarResponse(BaseModel):
 # --------------------------------------------------------------------
 
 
-def gerar_codigo_licenca(tamanho: int = 8) -> str:
-    caracteres = string.ascii_uppercase + string.digits
-    base = "".join(random.choice(caracteres) for _ in range(tamanho))
-    return base[:4] + "-" + base[4:]
+# Alfabeto dos códigos de licença e gerador criptograficamente seguro
+# (o código funciona como senha, então não usamos o random padrão)
+_ALPHABET = string.ascii_uppercase + string.digits
+_RNG = secrets.SystemRandom()
+
+
+def gerar_codigo_licenca(tamanho: int = 12) -> str:
+    # 36^12 ≈ 4.7e18 combinações (~62 bits): colisão é desprezível mesmo com
+    # milhões de licenças. Agrupa de 4 em 4 para facilitar a digitação
+    # (ex.: "AB12-CD34-EF56").
+    base = "".join(_RNG.choices(_ALPHABET, k=tamanho))
+    return "-".join(base[i : i + 4] for i in range(0, tamanho, 4))
+
+
+def montar_documento_licenca(
+    email: str,
+    cpf: Optional[str],
+    id_transacao_pagbank: str,
+    plano: str = "mensal",
+) -> dict:
+    agora = datetime.now(timezone.utc)
+    expira = agora + timedelta(days=DEFAULT_LICENCE_DAYS)
+
+    return {
+        "email": email,
+        "cpf": cpf,
+        "status": "ativo",
+        "compra_em": agora,
+        "expira_em": expira,
+        "plano": plano,
+        "origem_pagamento": "pagbank",
+        "id_transacao_pagbank": id_transacao_pagbank,
+    }
+
+
+class TransacaoJaProcessada(Exception):
+    """A transação do PagBank já tinha gerado licença antes."""
+
+
+def montar_marcador_transacao() -> dict:
+    agora = datetime.now(timezone.utc)
+    return {
+        "ts": agora,
+        "apagar_em": agora + timedelta(days=PAGBANK_SEEN_TTL_DAYS),
+    }
 
 
-def criar_documento_licenca(
+async def criar_documento_licenca(
     codigo: str,
     email: str,
     cpf: Optional[str],
     id_transacao_pagbank: str,
     plano: str = "mensal",
+    marcar_transacao: bool = False,
 ) -> None:
     if db is None:
         raise RuntimeError("Firestore não inicializado corretamente")
 
-    agora = datetime.now(timezone.utc)
-    expira = agora + timedelta(days=DEFAULT_LICENCE_DAYS)
+    # create() falha com AlreadyExists se o código já existir, então não
+    # precisamos consultar o documento antes de gravar
+    doc_ref = LICENCES_COL.document(codigo)
+    dados = montar_documento_licenca(email, cpf, id_transacao_pagbank, plano)
+    if not marcar_transacao:
+        await doc_ref.create(dados)
+        return
 
-    doc_ref = db.collection(LICENCES_COLLECTION).document(codigo)
-    doc_ref.set(
-        {
-            "email": email,
-            "cpf": cpf,
-            "status": "ativo",
-            "compra_em": agora,
-            "expira_em": expira,
-            "plano": plano,
-            "origem_pagamento": "pagbank",
-            "id_transacao_pagbank": id_transacao_pagbank,
-        }
+    # Licença e marcador da transação no mesmo commit: ou os dois são
+    # gravados, ou nenhum (sem compensação se a licença falhar)
+    batch = db.batch()
+    batch.create(
+        PAGBANK_SEEN_COL.document(id_transacao_pagbank), montar_marcador_transacao()
     )
+    batch.create(doc_ref, dados)
+    await batch.commit()
 
 
-def enviar_email_licenca(
-    para_email: str,
-    codigo_licenca: str,
-) -> None:
-    if not (SMTP_HOST and SMTP_USER and SMTP_PASSWORD and FROM_EMAIL):
-        print("SMTP não configurado. Dados da licença:")
-        print(f"Destinatário: {para_email}")
-        print(f"Licença: @#{codigo_licenca}")
-        print(f"Api-Key MeuDanfe: @@{MEUDANFE_API_KEY}")
-        return
+async def emitir_licenca(
+    email: str,
+    cpf: Optional[str],
+    id_transacao_pagbank: str,
+    plano: str = "mensal",
+    marcar_transacao: bool = False,
+) -> str:
+    """
+    Gera um código novo e grava a licença, devolvendo o código.
+    Colisão em 36^12 é improvável; se acontecer, o create() acusa e tentamos
+    de novo com outro código (até EMISSAO_TENTATIVAS vezes). É uma única
+    chamada ao Firestore por tentativa, sem leitura prévia.
+
+    Com marcar_transacao=True, a transação do PagBank é marcada como
+    processada no mesmo commit da licença; se ela já estava marcada, levanta
+    TransacaoJaProcessada. Dois webhooks simultâneos da mesma transação não
+    passam os dois, pois só um dos create() do marcador vence.
+    """
+    async with _EMISSAO_SEMAPHORE:
+        for tentativa in range(1, EMISSAO_TENTATIVAS + 1):
+            codigo = gerar_codigo_licenca()
+            try:
+                await criar_documento_licenca(
+                    codigo, email, cpf, id_transacao_pagbank, plano, marcar_transacao
+                )
+                return codigo
+            except AlreadyExists:
+                # O commit não diz qual documento já existia: só nesse caso
+                # raro lemos o marcador para separar reenvio de colisão
+                if marcar_transacao and await transacao_ja_processada(
+                    id_transacao_pagbank
+                ):
+                    raise TransacaoJaProcessada(id_transacao_pagbank)
+                if tentativa == EMISSAO_TENTATIVAS:
+                    raise
+                log.warning(
+                    "Código de licença já existia, gerando outro: %s",
+                    codigo,
+                )
+
+
+async def transacao_ja_processada(transaction_code: str) -> bool:
+    snap = await PAGBANK_SEEN_COL.document(transaction_code).get()
+    return snap.exists
+
+
+def smtp_configurado() -> bool:
+    return bool(SMTP_HOST and SMTP_USER and SMTP_PASSWORD and FROM_EMAIL)
+
+
+class SMTPPool:
+    """
+    Pool de conexões SMTP autenticadas, reaproveitadas entre os envios para
+    não repetir TCP + STARTTLS + LOGIN a cada e-mail.
+
+    Cada vaga da fila guarda (conexão ou None, mensagens enviadas, último
+    uso). Tirar a vaga da fila dá acesso exclusivo à conexão, então não é
+    preciso lock. None indica uma vaga sem conexão aberta, que é conectada
+    sob demanda. Conexões ociosas há mais de `ociosidade_max` segundos passam
+    por um NOOP antes do uso, e são reabertas se o servidor já as derrubou.
+    """
 
-    assunto = "Sua licença da extensão de NF"
-    corpo = f"""
+    def __init__(self, tamanho: int, max_mensagens: int, ociosidade_max: float = 30):
+        self.tamanho = tamanho
+        self.max_mensagens = max_mensagens
+        self.ociosidade_max = ociosidade_max
+        self._fila: asyncio.Queue = asyncio.Queue(maxsize=tamanho)
+
+    @staticmethod
+    async def _conectar() -> aiosmtplib.SMTP:
+        server = aiosmtplib.SMTP(
+            hostname=SMTP_HOST,
+            port=SMTP_PORT,
+            start_tls=False,
+            timeout=SMTP_TIMEOUT,
+        )
+        await server.connect()
+        await server.starttls()
+        await server.login(SMTP_USER, SMTP_PASSWORD)
+        return server
+
+    @staticmethod
+    async def _fechar(server: Optional[aiosmtplib.SMTP]) -> None:
+        if server is None:
+            return
+        try:
+            await server.quit()
+        except Exception:
+            server.close()
+
+    async def _saudavel(
+        self, server: Optional[aiosmtplib.SMTP], usado_em: float
+    ) -> bool:
+        if server is None or not server.is_connected:
+            return False
+        if time.monotonic() - usado_em < self.ociosidade_max:
+            return True
+        try:
+            await server.noop()
+            return True
+        except aiosmtplib.SMTPException:
+            return False
+
+    async def iniciar(self) -> None:
+        # Abre as conexões em paralelo: a subida espera no máximo um
+        # SMTP_TIMEOUT, mesmo com o servidor inacessível
+        resultados = await asyncio.gather(
+            *(self._conectar() for _ in range(self.tamanho)),
+            return_exceptions=True,
+        )
+        for resultado in resultados:
+            server = resultado
+            if isinstance(resultado, BaseException):
+                log.warning(
+                    "Erro ao abrir conexão SMTP (será tentada no envio): %s",
+                    resultado,
+                )
+                server = None
+            self._fila.put_nowait((server, 0, time.monotonic()))
+
+    async def fechar(self) -> None:
+        while not self._fila.empty():
+            server, _, _ = self._fila.get_nowait()
+            await self._fechar(server)
+
+    async def enviar(self, *msgs: MIMEText) -> list[tuple[int, Exception]]:
+        """
+        Envia as mensagens em sequência por uma mesma conexão do pool.
+        Recusas do servidor para uma mensagem (destinatário inválido etc.)
+        não interrompem as demais e voltam como [(índice, erro)]; falhas de
+        conexão que persistem após reconectar são propagadas.
+        """
+        falhas: list[tuple[int, Exception]] = []
+        server, enviadas, usado_em = await self._fila.get()
+        try:
+            for indice, msg in enumerate(msgs):
+                if enviadas >= self.max_mensagens or not await self._saudavel(
+                    server, usado_em
+                ):
+                    # Conexão inexistente, caída ou já muito usada: recicla
+                    await self._fechar(server)
+                    server, enviadas = None, 0
+                    server = await self._conectar()
+
+                try:
+                    try:
+                        await server.send_message(msg)
+                    except aiosmtplib.SMTPServerDisconnected:
+                        # O servidor derrubou a conexão entre o teste e o
+                        # envio: reconecta e tenta mais uma vez
+                        server, enviadas = None, 0
+                        server = await self._conectar()
+                        await server.send_message(msg)
+                except (
+                    aiosmtplib.SMTPResponseException,
+                    aiosmtplib.SMTPRecipientsRefused,
+                ) as e:
+                    falhas.append((indice, e))
+                enviadas += 1
+                usado_em = time.monotonic()
+        except Exception:
+            # Não devolve ao pool uma conexão em estado desconhecido
+            await self._fechar(server)
+            server, enviadas = None, 0
+            raise
+        finally:
+            self._fila.put_nowait((server, enviadas, usado_em))
+        return falhas
+
+
+SMTP_POOL = SMTPPool(SMTP_POOL_SIZE, SMTP_MAX_MENSAGENS_POR_CONEXAO)
+
+
+# Corpo do e-mail da licença. As partes fixas (Api-Key e validade) são
+# preenchidas uma vez aqui; por e-mail só entra o código da licença.
+_EMAIL_CORPO = """
 Olá!
 
 Obrigado pela sua compra.
@@ -188,93 +561,300 @@ Obrigado pela sua compra.
 Aqui estão seus dados de acesso:
 
 Chave da extensão (licença):
-  @#{codigo_licenca}
+  @#$codigo
 
 Api-Key do MeuDanfe (não compartilhe):
-  @@{MEUDANFE_API_KEY}
+  @@$api_key
 
 Como usar:
 1. Instale a extensão no Chrome.
 2. Abra o popup da extensão.
 3. Em uma anotação, digite a linha com a licença:
-   @#{codigo_licenca}
+   @#$codigo
 4. A extensão irá validar sua licença automaticamente.
 5. A Api-Key do MeuDanfe será usada pelo sistema para baixar suas notas.
 
-Validade da licença: {DEFAULT_LICENCE_DAYS} dias a partir da data da compra.
+Validade da licença: $dias dias a partir da data da compra.
 
 Qualquer dúvida, responda este e-mail.
 
 Abraço!
 """
+_EMAIL_TEMPLATE = string.Template(
+    string.Template(_EMAIL_CORPO).safe_substitute(
+        # "$" na Api-Key não pode virar placeholder no segundo Template
+        api_key=MEUDANFE_API_KEY.replace("$", "$$"),
+        dias=DEFAULT_LICENCE_DAYS,
+    )
+)
+_EMAIL_ASSUNTO = Header("Sua licença da extensão de NF", "utf-8").encode()
+
+
+def montar_email_licenca(para_email: str, codigo_licenca: str) -> MIMEText:
+    corpo = _EMAIL_TEMPLATE.substitute(codigo=codigo_licenca)
 
     msg = MIMEText(corpo, _charset="utf-8")
-    msg["Subject"] = assunto
+    msg["Subject"] = _EMAIL_ASSUNTO
     msg["From"] = FROM_EMAIL
     msg["To"] = para_email
+    return msg
 
-    with smtplib.SMTP(SMTP_HOST, SMTP_PORT) as server:
-        server.starttls()
-        server.login(SMTP_USER, SMTP_PASSWORD)
-        server.send_message(msg)
 
+def registrar_licenca_sem_smtp(para_email: str, codigo_licenca: str) -> None:
+    log.warning(
+        "SMTP não configurado. Dados da licença:\n"
+        "Destinatário: %s\nLicença: @#%s\nApi-Key MeuDanfe: @@%s",
+        para_email,
+        codigo_licenca,
+        MEUDANFE_API_KEY,
+    )
+
+
+def registrar_falha_email(para_email: str, codigo_licenca: str, erro) -> None:
+    # O envio acontece depois da resposta ao PagBank: uma falha aqui não tem
+    # mais como virar erro HTTP, então registramos o suficiente para reenviar
+    # a licença manualmente
+    log.error(
+        "ERRO ao enviar e-mail da licença %s para %s: %s",
+        codigo_licenca,
+        para_email,
+        erro,
+    )
+
+
+async def enviar_email_licenca(
+    para_email: str,
+    codigo_licenca: str,
+) -> None:
+    if not smtp_configurado():
+        registrar_licenca_sem_smtp(para_email, codigo_licenca)
+        return
+
+    falhas = await SMTP_POOL.enviar(montar_email_licenca(para_email, codigo_licenca))
+    if falhas:
+        raise falhas[0][1]
+
+
+async def enviar_email_licenca_em_segundo_plano(
+    para_email: str,
+    codigo_licenca: str,
+) -> None:
+    try:
+        await enviar_email_licenca(para_email, codigo_licenca)
+    except Exception as e:
+        registrar_falha_email(para_email, codigo_licenca, e)
+
+
+# Fila de e-mails de licença pendentes: o webhook só enfileira (email, código)
+# e uma única tarefa consome a fila em lotes de até MAIL_LOTE_MAX mensagens
+# (esperando no máximo MAIL_LOTE_ESPERA segundos para completar o lote),
+# mandando cada lote pela mesma conexão SMTP autenticada.
+# None na fila é o aviso de desligamento: o despachante envia o que já pegou
+# e termina (tudo o que entrou antes dele sai junto, a fila é FIFO)
+MAIL_QUEUE: "asyncio.Queue[Optional[tuple[str, str]]]" = asyncio.Queue(maxsize=10000)
+MAIL_LOTE_MAX = 50
+MAIL_LOTE_ESPERA = 0.2
+
+
+async def enviar_lote_emails(lote: list[tuple[str, str]]) -> None:
+    if not smtp_configurado():
+        for para_email, codigo_licenca in lote:
+            registrar_licenca_sem_smtp(para_email, codigo_licenca)
+        return
+
+    try:
+        falhas = await SMTP_POOL.enviar(
+            *(montar_email_licenca(email, codigo) for email, codigo in lote)
+        )
+    except Exception as e:
+        # Falha de conexão: não dá pra saber quais saíram, registra o lote todo
+        for para_email, codigo_licenca in lote:
+            registrar_falha_email(para_email, codigo_licenca, e)
+        return
+
+    for indice, erro in falhas:
+        registrar_falha_email(*lote[indice], erro)
 
-def buscar_licenca(codigo: str) -> Optional[dict]:
-    if db is None:
-        raise RuntimeError("Firestore não inicializado corretamente")
 
-    doc_ref = db.collection(LICENCES_COLLECTION).document(codigo)
-    doc = doc_ref.get()
+async def despachar_fila_emails():
+    loop = asyncio.get_running_loop()
+    lote: list[tuple[str, str]] = []
+    encerrar = False
+    try:
+        while not encerrar:
+            item = await MAIL_QUEUE.get()
+            if item is None:
+                break
+            lote = [item]
+            limite = loop.time() + MAIL_LOTE_ESPERA
+            while len(lote) < MAIL_LOTE_MAX:
+                restante = limite - loop.time()
+                if restante <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(MAIL_QUEUE.get(), restante)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    encerrar = True
+                    break
+                lote.append(item)
+
+            await enviar_lote_emails(lote)
+            lote = []
+    except asyncio.CancelledError:
+        # Cancelado no meio de um lote: o que já saiu da fila não seria
+        # enviado por ninguém, então fica registrado para reenvio manual
+        for para_email, codigo_licenca in lote:
+            registrar_falha_email(
+                para_email, codigo_licenca, "envio cancelado no desligamento"
+            )
+        raise
+
+
+_despacho_emails_task: Optional[asyncio.Task] = None
+
+
+@app.on_event("startup")
+async def iniciar_envio_emails():
+    global _despacho_emails_task
+    if smtp_configurado():
+        await SMTP_POOL.iniciar()
+    _despacho_emails_task = asyncio.create_task(despachar_fila_emails())
+
+
+@app.on_event("shutdown")
+async def encerrar_envio_emails():
+    # Avisa o despachante e espera ele esvaziar a fila (inclusive o lote que
+    # estiver montando) antes de fechar as conexões
+    if _despacho_emails_task is not None and not _despacho_emails_task.done():
+        await MAIL_QUEUE.put(None)
+        await _despacho_emails_task
+
+    # Sem despachante rodando, manda direto o que tiver sobrado na fila
+    pendentes = []
+    while not MAIL_QUEUE.empty():
+        item = MAIL_QUEUE.get_nowait()
+        if item is not None:
+            pendentes.append(item)
+    if pendentes:
+        await enviar_lote_emails(pendentes)
+
+    await SMTP_POOL.fechar()
+
+
+def resumir_licenca(data: dict) -> dict:
+    """
+    Guarda só o que a validação usa, com a data de expiração já formatada
+    em ISO 8601 para não refazer o isoformat() a cada consulta.
+    """
+    expira_em = data.get("expira_em")
+    expira_dt = expira_em if isinstance(expira_em, datetime) else None
+    return {
+        "status": data.get("status", "ativo"),
+        "expira_dt": expira_dt,
+        "expira_iso": expira_dt.isoformat() if expira_dt else None,
+    }
+
+
+async def ler_licenca_firestore(codigo: str) -> Optional[dict]:
+    doc_ref = LICENCES_COL.document(codigo)
+    doc = await doc_ref.get()
     if not doc.exists:
+        _LIC_CACHE.pop(codigo, None)
         return None
-    return doc.to_dict()
+
+    data = resumir_licenca(doc.to_dict())
+    _LIC_CACHE[codigo] = (time.monotonic(), data)
+    return data
+
+
+async def revalidar_licenca(codigo: str) -> None:
+    try:
+        await ler_licenca_firestore(codigo)
+    except Exception as e:
+        log.warning("Erro ao revalidar licença no cache %s: %s", codigo, e)
+    finally:
+        _LIC_REVALIDANDO.pop(codigo, None)
+
+
+async def buscar_licenca(codigo: str) -> Optional[dict]:
+    if db is None:
+        raise RuntimeError("Firestore não inicializado corretamente")
+
+    entrada = _LIC_CACHE.get(codigo)
+    if entrada is None:
+        return await ler_licenca_firestore(codigo)
+
+    lido_em, data = entrada
+    if (
+        time.monotonic() - lido_em > LIC_CACHE_STALE_AFTER
+        and codigo not in _LIC_REVALIDANDO
+    ):
+        _LIC_REVALIDANDO[codigo] = asyncio.create_task(revalidar_licenca(codigo))
+    return data
+
+
+# Parser do XML do PagBank (sem resolver entidades nem acessar a rede) e
+# consultas XPath compiladas uma vez só. smart_strings=False devolve str
+# comum (o orjson não serializa as subclasses de str do lxml).
+_XML_PARSER = etree.XMLParser(resolve_entities=False, no_network=True)
+_XP_STATUS = etree.XPath("string(.//status)", smart_strings=False)
+_XP_CODE = etree.XPath("string(.//code)", smart_strings=False)
+_XP_REFERENCE = etree.XPath("string(.//reference)", smart_strings=False)
+_XP_SENDER_EMAIL = etree.XPath("string(.//sender/email)", smart_strings=False)
+_XP_SENDER_DOCUMENT = etree.XPath(
+    "string(.//sender/documents/document/value)", smart_strings=False
+)
 
 
-def consultar_notificacao_pagbank(notification_code: str) -> Optional[dict]:
+async def consultar_notificacao_pagbank(notification_code: str) -> Optional[dict]:
     """
     Usa o notificationCode para consultar a transação na API v3 do PagBank/PagSeguro.
     Retorna um dicionário com alguns campos importantes (status, email, cpf, transaction_id).
     Documentação: GET /v3/transactions/notifications/{notificationCode}?email=&token=
     """
     if not PAGBANK_EMAIL or not PAGBANK_TOKEN:
-        print("PAGBANK_EMAIL ou PAGBANK_TOKEN não configurados; não dá pra consultar notificação.")
+        log.error(
+            "PAGBANK_EMAIL ou PAGBANK_TOKEN não configurados; "
+            "não dá pra consultar notificação."
+        )
         return None
 
     url = f"{PAGBANK_NOTIFICATION_BASE_URL}/{notification_code}"
     params = {"email": PAGBANK_EMAIL, "token": PAGBANK_TOKEN}
 
-    print("Consultando notificação PagBank:", url, params)
+    # (sem os params, que levam o token do PagBank)
+    log.debug("Consultando notificação PagBank: %s", url)
 
     try:
-        resp = requests.get(url, params=params, timeout=15)
+        resp = await HTTP.get(url, params=params)
     except Exception as e:
-        print("Erro HTTP consultando notificação PagBank:", e)
+        log.error("Erro HTTP consultando notificação PagBank: %s", e)
         return None
 
-    print("Status HTTP PagBank:", resp.status_code)
-    print("Resposta PagBank (XML):", resp.text)
+    log.debug("Status HTTP PagBank: %s", resp.status_code)
+    log.debug("Resposta PagBank (XML): %s", resp.text)
 
     if resp.status_code != 200:
+        log.error("PagBank respondeu HTTP %s: %s", resp.status_code, resp.text)
         return None
 
-    # Parse XML de resposta
+    # Parse XML de resposta (bytes: o próprio XML declara o encoding)
     try:
-        root = ET.fromstring(resp.text)
+        root = etree.fromstring(resp.content, _XML_PARSER)
     except Exception as e:
-        print("Erro ao parsear XML do PagBank:", e)
+        log.error("Erro ao parsear XML do PagBank: %s", e)
         return None
 
     # XML padrão: <transaction>...</transaction>
-    status_str = root.findtext(".//status")
-    transaction_code = root.findtext(".//code")
-    reference = root.findtext(".//reference")
-    email_cliente = root.findtext(".//sender/email")
+    status_str = _XP_STATUS(root) or None
+    transaction_code = _XP_CODE(root) or None
+    reference = _XP_REFERENCE(root) or None
+    email_cliente = _XP_SENDER_EMAIL(root) or None
 
     # CPF (se existir)
-    cpf = None
-    doc_value = root.findtext(".//sender/documents/document/value")
-    if doc_value:
-        cpf = doc_value
+    cpf = _XP_SENDER_DOCUMENT(root) or None
 
     info = {
         "status": status_str,
@@ -283,10 +863,30 @@ def consultar_notificacao_pagbank(notification_code: str) -> Optional[dict]:
         "email": email_cliente,
         "cpf": cpf,
     }
-    print("Dados extraídos da notificação PagBank:", info)
+    log.debug("Dados extraídos da notificação PagBank: %s", info)
     return info
 
 
+def origem_webhook_autorizada(request: Request) -> bool:
+    if PAGBANK_WEBHOOK_SECRET and not hmac.compare_digest(
+        request.query_params.get("secret", "").encode(),
+        PAGBANK_WEBHOOK_SECRET.encode(),
+    ):
+        return False
+
+    if PAGBANK_ALLOWED_NETWORKS:
+        if request.client is None:
+            return False
+        try:
+            ip = ipaddress.ip_address(request.client.host)
+        except ValueError:
+            return False
+        if not any(ip in rede for rede in PAGBANK_ALLOWED_NETWORKS):
+            return False
+
+    return True
+
+
 def status_pagbank_e_pago(status_str: Optional[str]) -> bool:
     """
     Na API antiga (PagSeguro), os status são números:
@@ -308,75 +908,164 @@ def status_pagbank_e_pago(status_str: Optional[str]) -> bool:
     return s in (3, 4)
 
 
+# --------------------------------------------------------------------
+# VARREDURA PERIÓDICA DE LICENÇAS EXPIRADAS
+# --------------------------------------------------------------------
+
+
+async def marcar_licencas_expiradas() -> int:
+    """
+    Marca como "expirado" todas as licenças ativas com expira_em no passado,
+    em commits de até FIRESTORE_BATCH_LIMIT documentos. Retorna quantas foram
+    atualizadas.
+    """
+    if db is None:
+        return 0
+
+    query = (
+        LICENCES_COL.where(filter=FieldFilter("status", "==", "ativo"))
+        .where(filter=FieldFilter("expira_em", "<", datetime.now(timezone.utc)))
+    )
+
+    total = 0
+    batch = db.batch()
+    pendentes = 0
+    async for doc in query.stream():
+        batch.update(doc.reference, {"status": "expirado"})
+        _LIC_CACHE.pop(doc.id, None)
+        pendentes += 1
+        if pendentes == FIRESTORE_BATCH_LIMIT:
+            await batch.commit()
+            total += pendentes
+            batch = db.batch()
+            pendentes = 0
+
+    if pendentes:
+        await batch.commit()
+        total += pendentes
+    return total
+
+
+_trava_varredura = None
+
+
+def adquirir_trava_varredura() -> bool:
+    """
+    Tenta pegar (sem bloquear) a trava de arquivo da varredura. O arquivo
+    fica aberto enquanto o processo viver; o SO libera a trava se ele morrer.
+    """
+    global _trava_varredura
+    if _trava_varredura is not None or fcntl is None:
+        return True
+
+    arquivo = open(EXPIRY_SWEEP_LOCK_FILE, "a")
+    try:
+        fcntl.flock(arquivo, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        arquivo.close()
+        return False
+    _trava_varredura = arquivo
+    log.info(
+        "Este worker (pid %s) fará a varredura de licenças expiradas", os.getpid()
+    )
+    return True
+
+
+async def varrer_licencas_expiradas():
+    while True:
+        try:
+            if not adquirir_trava_varredura():
+                await asyncio.sleep(EXPIRY_SWEEP_MINUTES * 60)
+                continue
+            total = await marcar_licencas_expiradas()
+            if total:
+                log.info("Licenças marcadas como expiradas: %s", total)
+        except Exception as e:
+            log.error("Erro na varredura de licenças expiradas: %s", e)
+        await asyncio.sleep(EXPIRY_SWEEP_MINUTES * 60)
+
+
+_varredura_task: Optional[asyncio.Task] = None
+
+
+@app.on_event("startup")
+async def iniciar_varredura_expiradas():
+    global _varredura_task
+    if db is not None and EXPIRY_SWEEP_ENABLED:
+        _varredura_task = asyncio.create_task(varrer_licencas_expiradas())
+
+
+@app.on_event("shutdown")
+async def parar_varredura_expiradas():
+    if _varredura_task is not None:
+        _varredura_task.cancel()
+
+
 # --------------------------------------------------------------------
 # ENDPOINT: WEBHOOK DO PAGBANK
 # --------------------------------------------------------------------
 
 
 @app.post("/pagbank/webhook")
-async def pagbank_webhook(request: Request):
+async def pagbank_webhook(request: Request, background: BackgroundTasks):
     """
     Webhook do PagBank.
 
     Fluxo:
+    0. Recusa com 401, sem ler o corpo, se a origem não passar nos filtros
     1. PagBank manda notificationCode / notificationType (form x-www-form-urlencoded)
     2. A gente lê e extrai o notificationCode
     3. Consulta a API de notificação do PagBank (v3) com esse código
-    4. Se status da transação for pago, gera licença + salva no Firestore + manda e-mail
+    4. Se status da transação for pago, gera licença + salva no Firestore
+    5. O e-mail com a licença é enviado em segundo plano, após a resposta
     """
 
-    print("=== Webhook PagBank recebido ===")
-    headers = dict(request.headers)
-    print("Headers:", headers)
-
-    content_type = headers.get("content-type", "")
-    raw_body = await request.body()
-    body_text = raw_body.decode(errors="ignore")
-    print("Raw body:", body_text)
-
-    data_form = {}
-    if "application/x-www-form-urlencoded" in content_type and body_text:
-        parsed = parse_qs(body_text)
-        data_form = {
-            k: (v[0] if isinstance(v, list) and v else v) for k, v in parsed.items()
-        }
-
-    notification_code = None
-    notification_type = None
-
-    if data_form:
-        print("Payload FORM PagBank parseado:", data_form)
-        notification_code = data_form.get("notificationCode") or data_form.get(
-            "notification_code"
-        )
-        notification_type = data_form.get("notificationType") or data_form.get(
-            "notification_type"
+    if not origem_webhook_autorizada(request):
+        log.warning(
+            "Webhook PagBank recusado (origem não autorizada): %s",
+            request.client.host if request.client else None,
         )
-        print("notificationCode:", notification_code, "notificationType:", notification_type)
+        return JSONResponse(status_code=401, content={"detail": "não autorizado"})
 
-    if not notification_code:
-        # tentativa extra: se algum dia vier JSON
+    log.info("=== Webhook PagBank recebido ===")
+    log.debug("Headers: %s", request.headers)
+
+    content_type = request.headers.get("content-type", "").lower()
+    raw_body = await request.body()
+    log.debug("Raw body: %r", raw_body)
+
+    # Usa só o parser correspondente ao Content-Type (o PagBank manda form;
+    # JSON fica como alternativa caso algum dia venha nesse formato)
+    data = {}
+    if "application/x-www-form-urlencoded" in content_type and raw_body:
+        data = await request.form()
+        log.debug("Payload FORM PagBank parseado: %s", data)
+    elif "application/json" in content_type:
         try:
-            data_json = await request.json()
-            print("Payload JSON PagBank:", data_json)
-            notification_code = data_json.get("notificationCode") or data_json.get(
-                "notification_code"
-            )
-            notification_type = data_json.get("notificationType") or data_json.get(
-                "notification_type"
-            )
-        except Exception as e:
-            print("Erro ao ler JSON do PagBank:", e)
+            data = orjson.loads(raw_body)
+            log.debug("Payload JSON PagBank: %s", data)
+        except orjson.JSONDecodeError as e:
+            log.warning("Erro ao ler JSON do PagBank: %s", e)
+        if not isinstance(data, dict):
+            data = {}
+
+    notification_code = data.get("notificationCode") or data.get("notification_code")
+    notification_type = data.get("notificationType") or data.get("notification_type")
+    log.info(
+        "notificationCode: %s notificationType: %s",
+        notification_code,
+        notification_type,
+    )
 
     if not notification_code:
-        print("Nenhum notificationCode encontrado no webhook.")
+        log.warning("Nenhum notificationCode encontrado no webhook.")
         return JSONResponse(
             status_code=400,
             content={"detail": "notificationCode não encontrado no payload"},
         )
 
     # Consulta a notificação na API do PagBank
-    info = consultar_notificacao_pagbank(notification_code)
+    info = await consultar_notificacao_pagbank(notification_code)
     if not info:
         # Não vamos devolver erro 4xx pra não fazer o PagBank ficar reenviando.
         # Apenas logamos e retornamos 200 com info de erro.
@@ -389,36 +1078,49 @@ async def pagbank_webhook(request: Request):
 
     if not email_cliente:
         # se por algum motivo o e-mail não vier, não gera licença para não ficar "vaga"
-        print("E-mail do cliente não veio na notificação PagBank; não gerando licença.")
+        log.warning(
+            "E-mail do cliente não veio na notificação PagBank; não gerando licença."
+        )
         return {"ok": False, "motivo": "SEM_EMAIL_CLIENTE"}
 
     if not status_pagbank_e_pago(status_str):
-        print(f"Transação com status {status_str}, não é pago. Ignorando.")
+        log.info("Transação com status %s, não é pago. Ignorando.", status_str)
         return {"ok": True, "ignored": True, "status": status_str}
 
     if db is None:
-        print("Firestore não está inicializado, não foi possível salvar licença.")
+        log.error("Firestore não está inicializado, não foi possível salvar licença.")
         return {"ok": False, "motivo": "FIRESTORE_INDISPONIVEL"}
 
-    # Gera código de licença único
-    codigo = gerar_codigo_licenca()
-    while db.collection(LICENCES_COLLECTION).document(codigo).get().exists:
-        codigo = gerar_codigo_licenca()
-
-    criar_documento_licenca(
-        codigo=codigo,
-        email=email_cliente,
-        cpf=cpf_cliente,
-        id_transacao_pagbank=transaction_code,
-        plano="mensal",
-    )
+    # O PagBank reenvia notificações e manda uma nova a cada mudança de status
+    # (ex.: 3 = Paga e depois 4 = Disponível); só a primeira gera licença.
+    # Se a gravação falhar, nada fica marcado e um reenvio tenta de novo.
+    try:
+        codigo = await emitir_licenca(
+            email=email_cliente,
+            cpf=cpf_cliente,
+            id_transacao_pagbank=transaction_code,
+            plano="mensal",
+            marcar_transacao=True,
+        )
+    except TransacaoJaProcessada:
+        log.info(
+            "Transação já processada, ignorando notificação repetida: %s",
+            transaction_code,
+        )
+        return {"ok": True, "duplicate": True, "status": status_str}
 
-    enviar_email_licenca(
-        para_email=email_cliente,
-        codigo_licenca=codigo,
-    )
+    # O e-mail sai depois que a resposta 200 já foi enviada ao PagBank, pela
+    # fila de envio em lote; se a fila estiver cheia, vai avulso em segundo plano
+    try:
+        MAIL_QUEUE.put_nowait((email_cliente, codigo))
+    except asyncio.QueueFull:
+        background.add_task(
+            enviar_email_licenca_em_segundo_plano,
+            para_email=email_cliente,
+            codigo_licenca=codigo,
+        )
 
-    print("Licença gerada e salva no Firestore:", codigo)
+    log.info("Licença gerada e salva no Firestore: %s", codigo)
 
     return {
         "ok": True,
@@ -433,54 +1135,96 @@ async def pagbank_webhook(request: Request):
 # --------------------------------------------------------------------
 
 
-@app.post("/licencas/validar", response_model=LicencaValidarResponse)
-async def validar_licenca(body: LicencaValidarRequest):
-    codigo = body.licenca.strip().upper()
-
-    if codigo.startswith("@#"):
-        codigo = codigo[2:].strip().upper()
+async def avaliar_licenca(codigo: str) -> dict:
+    if not _LIC_RE.fullmatch(codigo):
+        return resposta_validacao(
+            ok=False,
+            motivo="LICENCA_INEXISTENTE",
+        )
 
-    lic = buscar_licenca(codigo)
+    lic = await buscar_licenca(codigo)
     if lic is None:
-        return LicencaValidarResponse(
+        return resposta_validacao(
             ok=False,
             motivo="LICENCA_INEXISTENTE",
         )
 
-    status = lic.get("status", "ativo")
+    status = lic["status"]
     if status != "ativo":
-        return LicencaValidarResponse(
+        return resposta_validacao(
             ok=False,
             motivo=f"LICENCA_{status.upper()}",
         )
 
-    expira_em = lic.get("expira_em")
-    agora = datetime.now(timezone.utc)
-
-    expira_dt: Optional[datetime] = None
-
-    if isinstance(expira_em, datetime):
-        expira_dt = expira_em
-
-    if expira_dt and expira_dt < agora:
-        if db is not None:
-            db.collection(LICENCES_COLLECTION).document(codigo).update(
-                {"status": "expirado"}
-            )
-
-        return LicencaValidarResponse(
+    expira_dt = lic["expira_dt"]
+    # A troca do status para "expirado" no Firestore fica com a varredura
+    # periódica; aqui basta comparar a data
+    if expira_dt and expira_dt < datetime.now(timezone.utc):
+        return resposta_validacao(
             ok=False,
             motivo="LICENCA_EXPIRADA",
-            expira_em=expira_dt.isoformat(),
+            expira_em=lic["expira_iso"],
         )
 
-    return LicencaValidarResponse(
+    return resposta_validacao(
         ok=True,
-        expira_em=expira_dt.isoformat() if expira_dt else None,
-        api_key_meudanfe=None,
+        expira_em=lic["expira_iso"],
     )
 
 
+def normalizar_codigo_licenca(texto: str) -> str:
+    texto = texto.strip()
+    if texto.startswith("@#"):
+        texto = texto[2:].lstrip()
+    return texto.upper()
+
+
+@app.post("/licencas/validar")
+async def validar_licenca(body: LicencaValidarRequest):
+    return await avaliar_licenca(normalizar_codigo_licenca(body.licenca))
+
+
+def etag_corresponde(if_none_match: Optional[str], etag: str) -> bool:
+    # Comparação fraca, como pede o If-None-Match: aceita lista de tags,
+    # "*" e W/"..." (proxies com gzip costumam enfraquecer o ETag)
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+@app.get("/licencas/{licenca}")
+async def consultar_licenca(licenca: str, request: Request):
+    """
+    Mesma resposta de POST /licencas/validar, mas em GET para poder ser
+    cacheada: ETag + Cache-Control deixam a extensão reaproveitar a última
+    resposta por VALIDACAO_MAX_AGE segundos e, depois disso, revalidar com
+    If-None-Match recebendo só um 304 sem corpo se nada mudou.
+
+    O código da licença (que funciona como senha) vai no caminho da URL. Ele
+    é mascarado no log de acesso do uvicorn (ver OcultarSegredoAccessLog),
+    mas proxies e o log de requisições da plataforma (ex.: Cloud Run) ainda
+    gravam a URL completa: restrinja quem lê esses logs, ou use o POST quando
+    isso não for possível.
+    """
+    codigo = normalizar_codigo_licenca(licenca)
+    resultado = await avaliar_licenca(codigo)
+
+    etag = '"%s"' % hashlib.blake2b(
+        codigo.encode() + orjson.dumps(resultado), digest_size=8
+    ).hexdigest()
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"private, max-age={VALIDACAO_MAX_AGE}",
+    }
+    if etag_corresponde(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return ORJSONResponse(resultado, headers=headers)
+
+
 # --------------------------------------------------------------------
 # ENDPOINT SIMPLES SÓ PRA TESTAR SE A API ESTÁ NO AR
 # --------------------------------------------------------------------
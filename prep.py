@@ -0,0 +1,24 @@
+"""
+Entrypoint do container.
+
+Grava o JSON do service account (variável GOOGLE_SERVICE_ACCOUNT_JSON) em um
+arquivo uma única vez, aponta GOOGLE_APPLICATION_CREDENTIALS para ele e
+substitui este processo pelo uvicorn (os argumentos são repassados).
+Assim cada worker só carrega as credenciais padrão do Google (ADC) do
+arquivo, sem precisar tratar o JSON da variável de ambiente.
+"""
+
+import os
+import sys
+
+SERVICE_ACCOUNT_PATH = os.getenv("SERVICE_ACCOUNT_PATH", "/tmp/sa.json")
+
+service_account_json = os.environ.pop("GOOGLE_SERVICE_ACCOUNT_JSON", None)
+if service_account_json:
+    fd = os.open(SERVICE_ACCOUNT_PATH, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(service_account_json)
+    os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = SERVICE_ACCOUNT_PATH
+    print(f"Credenciais do service account gravadas em {SERVICE_ACCOUNT_PATH}")
+
+os.execvp("uvicorn", ["uvicorn", *sys.argv[1:]])
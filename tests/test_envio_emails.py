@@ -0,0 +1,104 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault("MEUDANFE_API_KEY", "teste")
+os.environ.setdefault("USE_SERVICE_ACCOUNT_FILE", "false")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+class PoolFalso:
+    def __init__(self):
+        self.enviados = []
+        # Se definidos, enviar() avisa em_envio e espera liberar
+        self.em_envio = None
+        self.liberar = None
+
+    async def iniciar(self):
+        pass
+
+    async def fechar(self):
+        pass
+
+    async def enviar(self, *msgs):
+        if self.liberar is not None:
+            self.em_envio.set()
+            await self.liberar.wait()
+        self.enviados.extend(msg["To"] for msg in msgs)
+        return []
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    pool = PoolFalso()
+    monkeypatch.setattr(main, "SMTP_POOL", pool)
+    monkeypatch.setattr(main, "smtp_configurado", lambda: True)
+    monkeypatch.setattr(
+        main, "montar_email_licenca", lambda email, codigo: {"To": email}
+    )
+    return pool
+
+
+def test_desligamento_com_lote_sendo_montado(pool, monkeypatch):
+    async def cenario():
+        monkeypatch.setattr(main, "MAIL_QUEUE", asyncio.Queue())
+        await main.iniciar_envio_emails()
+        for i in range(3):
+            main.MAIL_QUEUE.put_nowait((f"cliente{i}@exemplo.com", f"COD{i}"))
+        # Deixa o despachante tirar o primeiro item e começar a montar o lote
+        await asyncio.sleep(0)
+        await main.encerrar_envio_emails()
+
+    asyncio.run(cenario())
+
+    assert sorted(pool.enviados) == [f"cliente{i}@exemplo.com" for i in range(3)]
+
+
+def test_desligamento_com_lote_em_envio(pool, monkeypatch):
+    async def cenario():
+        monkeypatch.setattr(main, "MAIL_QUEUE", asyncio.Queue())
+        pool.em_envio = asyncio.Event()
+        pool.liberar = asyncio.Event()
+        await main.iniciar_envio_emails()
+        for i in range(3):
+            main.MAIL_QUEUE.put_nowait((f"cliente{i}@exemplo.com", f"COD{i}"))
+        await pool.em_envio.wait()
+
+        # O lote está preso no envio; este entra na fila depois dele
+        main.MAIL_QUEUE.put_nowait(("cliente3@exemplo.com", "COD3"))
+        desligamento = asyncio.create_task(main.encerrar_envio_emails())
+        await asyncio.sleep(0)
+        assert not desligamento.done()
+
+        pool.liberar.set()
+        await desligamento
+
+    asyncio.run(cenario())
+
+    assert sorted(pool.enviados) == [f"cliente{i}@exemplo.com" for i in range(4)]
+
+
+def test_cancelamento_registra_lote_em_andamento(pool, monkeypatch):
+    falhas = []
+    monkeypatch.setattr(
+        main, "registrar_falha_email", lambda email, codigo, erro: falhas.append(codigo)
+    )
+
+    async def cenario():
+        monkeypatch.setattr(main, "MAIL_QUEUE", asyncio.Queue())
+        tarefa = asyncio.create_task(main.despachar_fila_emails())
+        main.MAIL_QUEUE.put_nowait(("cliente@exemplo.com", "COD"))
+        # O despachante pega o item e fica esperando completar o lote
+        await asyncio.sleep(0)
+        tarefa.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await tarefa
+
+    asyncio.run(cenario())
+
+    assert falhas == ["COD"]
+    assert pool.enviados == []